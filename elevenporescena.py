@@ -1,119 +1,303 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
-import io
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
+import tempfile
+import hashlib
 from datetime import datetime
-import json
+from collections import deque
 import time
 import os
 import zipfile
+import weakref
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+VERSIONS = ('a', 'b', 'c')
+TTS_URL = "https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+VOICES_URL = "https://api.elevenlabs.io/v1/voices"
+# Solicitudes simultáneas permitidas por la cuota de Eleven Labs
+MAX_WORKERS = 3
+# Conexiones reutilizables con la API para todo el proceso
+# (generaciones simultáneas esperadas × MAX_WORKERS)
+POOL_MAXSIZE = 32
+# Solicitudes de síntesis permitidas por minuto
+REQUESTS_PER_MINUTE = 10
+# Segundos máximos de espera por solicitud antes de abandonarla
+REQUEST_TIMEOUT = 60
+# Intentos por versión ante errores transitorios y espera base entre ellos
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0
+
+@st.cache_resource(show_spinner=False)
+def get_session():
+    """
+    Sesión compartida por todo el proceso para reutilizar las conexiones con la API;
+    Streamlit vuelve a ejecutar el script en cada interacción
+    """
+    session = requests.Session()
+    # Un único host; la sesión la comparten todas las generaciones simultáneas
+    session.mount("https://", HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=POOL_MAXSIZE,
+        # Solo fallos al conectar, cuando la solicitud aún no se ha enviado;
+        # errores de lectura y códigos HTTP se reintentan por versión
+        max_retries=Retry(
+            total=2,
+            read=0,
+            backoff_factor=0.5
+        )
+    ))
+    return session
+
+class RateLimiter:
+    """
+    Limita las solicitudes a un máximo por ventana deslizante de tiempo,
+    compartido entre todos los hilos
+    """
+    def __init__(self, max_requests, period=60.0):
+        self.max_requests = max_requests
+        self.period = period
+        self._timestamps = deque()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """
+        Espera solo lo necesario para no superar el límite y registra la solicitud
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= self.period:
+                    self._timestamps.popleft()
+                
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if len(self._timestamps) < self.max_requests:
+                        self._timestamps.append(now)
+                        return
+                    wait = self.period - (now - self._timestamps[0])
+            time.sleep(wait)
+    
+    def update(self, headers):
+        """
+        Ajusta la espera según las cabeceras devueltas por la API
+        """
+        retry_after = headers.get('retry-after')
+        if retry_after is None:
+            return
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            return
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter(api_key):
+    """
+    Limitador por API key para todo el proceso, compartido entre sesiones y
+    ejecuciones; la cuota de Eleven Labs es de cada cuenta
+    """
+    return RateLimiter(REQUESTS_PER_MINUTE)
 
 # Inicialización del estado de la sesión
 if 'current_generation' not in st.session_state:
     st.session_state.current_generation = {
-        'zip_contents': None,
+        'zip_files': None,
+        'scenes': [],
         'timestamp': None,
         'files_generated': False
     }
 
+def create_executor(max_workers):
+    """
+    Crea un ThreadPoolExecutor cuyos hilos comparten el contexto de la ejecución
+    actual; sin él, st.cache_data y st.cache_resource no guardan nada en los hilos
+    """
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx())
+    )
+
 def split_into_scenes(text):
     """
     Divide el texto en escenas usando '//' como separador
     y limpia cada escena
     """
     # Dividir por '//' y limpiar espacios en blanco
-    scenes = [scene.strip() for scene in text.split('//') if scene.strip()]
-    return scenes
+    scenes = (scene.strip() for scene in text.split('//'))
+    return [scene for scene in scenes if scene]
 
-def generate_audio_with_retries(text, api_key, voice_id, stability, similarity, use_speaker_boost, 
-                              scene_number, retries=2, model_id="eleven_multilingual_v2"):
+@st.cache_data(show_spinner=False, max_entries=1024, ttl=24 * 3600)
+def _tts_once(url, data, headers, letter, _session, _rate_limiter):
     """
-    Genera audio usando la API de Eleven Labs con reintentos automáticos
+    Solicita un audio a la API de Eleven Labs y devuelve el MP3.
+    La letra forma parte de la clave de caché para conservar las tres versiones;
+    la sesión y el limitador no (Streamlit omite los argumentos con _).
     """
-    results = []
-    letters = ['a', 'b', 'c']
+    _rate_limiter.acquire()
+    response = _session.post(url, json=data, headers=headers, timeout=REQUEST_TIMEOUT)
+    _rate_limiter.update(response.headers)
+    response.raise_for_status()
     
-    for attempt in range(retries + 1):
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
-        
-        headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": api_key
-        }
-        
-        data = {
-            "text": text,
-            "model_id": model_id,
-            "voice_settings": {
-                "stability": stability,
-                "similarity_boost": similarity,
-                "style": 0,
-                "use_speaker_boost": use_speaker_boost
-            }
+    return response.content
+
+def request_not_sent(error):
+    """
+    Indica si un error de red ocurrió al conectar, antes de enviar la solicitud,
+    de modo que reintentarla no puede generar un cobro duplicado
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+def generate_audio_version(session, rate_limiter, text, api_key, voice_id, stability, similarity,
+                           use_speaker_boost, scene_number, letter,
+                           model_id="eleven_multilingual_v2"):
+    """
+    Genera una versión de audio usando la API de Eleven Labs,
+    reintentando ante errores transitorios (429, 5xx o de conexión)
+    """
+    # La solicitud no cambia entre intentos, se construye una sola vez
+    url = TTS_URL.format(voice_id=voice_id)
+    
+    headers = {
+        "Accept": "audio/mpeg",
+        "Content-Type": "application/json",
+        "xi-api-key": api_key
+    }
+    
+    data = {
+        "text": text,
+        "model_id": model_id,
+        "voice_settings": {
+            "stability": stability,
+            "similarity_boost": similarity,
+            "style": 0,
+            "use_speaker_boost": use_speaker_boost
         }
-        
+    }
+    
+    for attempt in range(MAX_RETRIES):
         try:
-            response = requests.post(url, json=data, headers=headers)
-            if response.status_code == 200:
-                filename = f"escena_{scene_number}{letters[attempt]}.mp3"
-                results.append({
-                    'content': response.content,
-                    'filename': filename,
-                    'text': text,
-                    'scene': scene_number
-                })
-                time.sleep(5.5)
-            else:
-                st.warning(f"Error en intento {attempt + 1}: {response.status_code}")
-        except Exception as e:
-            st.error(f"Error en la solicitud: {str(e)}")
+            content = _tts_once(url, data, headers, letter, session, rate_limiter)
+            break
+        except requests.HTTPError as e:
+            status_code = e.response.status_code
+            if attempt == MAX_RETRIES - 1 or (status_code != 429 and status_code < 500):
+                raise
+        except requests.RequestException as e:
+            # Si la solicitud llegó a enviarse, la API pudo sintetizar (y cobrar) el audio
+            if attempt == MAX_RETRIES - 1 or not request_not_sent(e):
+                raise
+        # En un 429 el limitador además respeta la cabecera Retry-After
+        time.sleep(RETRY_BACKOFF * 2 ** attempt)
     
-    return results
+    return {
+        'content': content,
+        'filename': f"escena_{scene_number}{letter}.mp3",
+        'text': text,
+        'scene': scene_number,
+        'version': letter
+    }
 
+def copy_audio_for_scene(audio, scene_number):
+    """
+    Reutiliza un audio generado para otra escena con el mismo texto
+    """
+    if audio['scene'] == scene_number:
+        return audio
+    return {
+        **audio,
+        'filename': f"escena_{scene_number}{audio['version']}.mp3",
+        'scene': scene_number
+    }
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def get_available_voices(api_key):
     """
-    Obtiene la lista de voces disponibles de Eleven Labs
+    Obtiene la lista de voces disponibles de Eleven Labs.
+    Los errores se propagan para que no queden guardados en la caché.
     """
-    url = "https://api.elevenlabs.io/v1/voices"
     headers = {
         "Accept": "application/json",
         "xi-api-key": api_key
     }
     
-    try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            voices = response.json()["voices"]
-            return {voice["name"]: voice["voice_id"] for voice in voices}
-        return {}
-    except:
-        return {}
+    response = get_session().get(VOICES_URL, headers=headers, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    voices = response.json()["voices"]
+    return {voice["name"]: voice["voice_id"] for voice in voices}
 
-def create_zip_files_by_version(audio_files):
+def build_zip(version, audio_files):
     """
-    Crea archivos ZIP separados para cada versión (a, b, c)
+    Escribe en un archivo temporal el ZIP de una versión y devuelve su ruta
     """
-    files_by_version = {
-        'a': [],
-        'b': [],
-        'c': []
-    }
+    with tempfile.NamedTemporaryFile(suffix=f"_{version}.zip", delete=False) as zip_buffer:
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+            for audio in audio_files:
+                zip_file.writestr(audio['filename'], audio['content'])
     
+    return zip_buffer.name
+
+def create_zip_files_by_version(audio_files):
+    """
+    Crea archivos ZIP separados para cada versión (a, b, c) en paralelo;
+    los audios se escriben en el orden recibido
+    """
+    files_by_version = {version: [] for version in VERSIONS}
     for audio in audio_files:
-        version = audio['filename'][-5]  # Obtiene la letra de la versión
-        files_by_version[version].append(audio)
+        files_by_version[audio['version']].append(audio)
     
-    zip_contents = {}
-    for version, files in files_by_version.items():
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Organizar por escenas
-            for audio in files:
-                zip_file.writestr(audio['filename'], audio['content'])
-        
-        zip_contents[version] = zip_buffer.getvalue()
+    with ThreadPoolExecutor(max_workers=len(VERSIONS)) as executor:
+        futures = {
+            version: executor.submit(build_zip, version, files)
+            for version, files in files_by_version.items()
+        }
+        zip_paths = {version: future.result() for version, future in futures.items()}
+    
+    return zip_paths
+
+def remove_zip_files(zip_paths):
+    """
+    Elimina del disco los ZIP de una generación anterior
+    """
+    for path in zip_paths.values():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class GeneratedZips:
+    """
+    Rutas de los ZIP de una generación; los archivos se eliminan del disco
+    cuando el objeto se libera (al terminar la sesión) o al cerrar el proceso
+    """
+    def __init__(self, paths):
+        self.paths = paths
+        self._finalizer = weakref.finalize(self, remove_zip_files, paths)
     
-    return zip_contents
+    def remove(self):
+        """
+        Elimina los ZIP inmediatamente
+        """
+        self._finalizer()
+
+def read_audio_from_zip(zip_path, scene_number, version):
+    """
+    Lee un audio de una escena desde el ZIP de su versión, si existe
+    """
+    with zipfile.ZipFile(zip_path) as zip_file:
+        try:
+            return zip_file.read(f"escena_{scene_number}{version}.mp3")
+        except KeyError:
+            return None
 
 def main():
     st.title("🎙️ Generador de Audio con Eleven Labs - Por Escenas")
@@ -131,6 +315,7 @@ def main():
     
     ### 🔄 Sistema de reintentos
     - Versiones: A, B y C por cada escena
+    - Cada versión se reintenta automáticamente ante errores temporales
     - Los archivos se nombrarán: escena_1a.mp3, escena_1b.mp3, etc.
     """)
     
@@ -158,10 +343,14 @@ def main():
     use_speaker_boost = st.sidebar.checkbox("Speaker Boost", value=True)
     
     if api_key:
-        voices = get_available_voices(api_key)
+        # La consulta está en caché por API key: las interacciones no llegan a la red
+        try:
+            voices = get_available_voices(api_key)
+        except Exception:
+            voices = {}
         if voices:
             selected_voice_name = st.sidebar.selectbox("Seleccionar voz", 
-                                                     list(voices.keys()))
+                                                     tuple(voices))
             voice_id = voices[selected_voice_name]
         else:
             st.sidebar.error("No se pudieron cargar las voces. Verifica tu API key.")
@@ -182,39 +371,77 @@ def main():
         status_text = st.empty()
         
         all_audio_files = []
-        total_scenes = len(scenes)
+        results_by_scene = {i: [] for i in range(1, len(scenes) + 1)}
         
+        # Agrupar escenas con texto idéntico para generarlas una sola vez
+        scenes_by_text = {}
         for i, scene in enumerate(scenes, 1):
-            status_text.text(f"Procesando escena {i}/{total_scenes}...")
+            text_key = hashlib.blake2b(scene.encode(), digest_size=16).digest()
+            scenes_by_text.setdefault(text_key, []).append(i)
+        
+        total_tasks = len(scenes_by_text) * len(VERSIONS)
+        completed = 0
+        
+        status_text.text(f"Generando {total_tasks} audios...")
+        
+        # Los recursos compartidos se obtienen en el hilo del script
+        session = get_session()
+        rate_limiter = get_rate_limiter(api_key)
+        executor = create_executor(MAX_WORKERS)
+        try:
+            futures = {}
+            for scene_numbers in scenes_by_text.values():
+                i = scene_numbers[0]
+                for letter in VERSIONS:
+                    future = executor.submit(
+                        generate_audio_version,
+                        session,
+                        rate_limiter,
+                        scenes[i - 1],
+                        api_key,
+                        voice_id,
+                        stability,
+                        similarity,
+                        use_speaker_boost,
+                        i,
+                        letter,
+                        model_id
+                    )
+                    futures[future] = (scene_numbers, letter)
             
-            # Mostrar preview de la escena actual
-            with st.expander(f"Escena {i}"):
-                st.write(scene)
-                
-                audio_results = generate_audio_with_retries(
-                    scene,
-                    api_key,
-                    voice_id,
-                    stability,
-                    similarity,
-                    use_speaker_boost,
-                    i
-                )
-                
-                all_audio_files.extend(audio_results)
+            for future in as_completed(futures):
+                scene_numbers, letter = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    st.warning(f"Error en escena {scene_numbers[0]}{letter}: {str(e)}")
+                else:
+                    for scene_number in scene_numbers:
+                        results_by_scene[scene_number].append(
+                            copy_audio_for_scene(result, scene_number)
+                        )
                 
-                # Mostrar los audios generados
-                for result in audio_results:
-                    st.audio(result['content'], format="audio/mp3")
-                    st.caption(f"Versión: {result['filename']}")
-            
-            progress_bar.progress((i) / total_scenes)
+                completed += 1
+                progress_bar.progress(completed / total_tasks)
+                status_text.text(f"Audios procesados {completed}/{total_tasks}...")
+        finally:
+            # Si Streamlit interrumpe la ejecución, no enviar las solicitudes pendientes
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        for i in range(1, len(scenes) + 1):
+            all_audio_files.extend(sorted(results_by_scene[i], key=lambda r: r['version']))
         
         status_text.text("¡Proceso completado! Preparando archivos ZIP...")
         
         if all_audio_files:
+            previous_zips = st.session_state.current_generation['zip_files']
+            if previous_zips:
+                previous_zips.remove()
+            
+            st.session_state.prepare_downloads = False
             st.session_state.current_generation = {
-                'zip_contents': create_zip_files_by_version(all_audio_files),
+                'zip_files': GeneratedZips(create_zip_files_by_version(all_audio_files)),
+                'scenes': scenes,
                 'timestamp': datetime.now().strftime("%Y%m%d_%H%M%S"),
                 'files_generated': True
             }
@@ -223,39 +450,56 @@ def main():
     if st.session_state.current_generation['files_generated']:
         st.subheader("📥 Descargar archivos generados")
         
-        col1, col2, col3 = st.columns(3)
-        
-        zip_contents = st.session_state.current_generation['zip_contents']
+        zip_paths = st.session_state.current_generation['zip_files'].paths
         timestamp = st.session_state.current_generation['timestamp']
         
-        with col1:
-            st.download_button(
-                label="⬇️ Descargar versión A",
-                data=zip_contents['a'],
-                file_name=f"escenas_versionA_{timestamp}.zip",
-                mime="application/zip",
-                key="download_a"
-            )
-        
-        with col2:
-            st.download_button(
-                label="⬇️ Descargar versión B",
-                data=zip_contents['b'],
-                file_name=f"escenas_versionB_{timestamp}.zip",
-                mime="application/zip",
-                key="download_b"
-            )
-        
-        with col3:
-            st.download_button(
-                label="⬇️ Descargar versión C",
-                data=zip_contents['c'],
-                file_name=f"escenas_versionC_{timestamp}.zip",
-                mime="application/zip",
-                key="download_c"
-            )
+        # Los botones cargan los ZIP completos en memoria en cada ejecución,
+        # por eso solo se crean cuando el usuario los pide
+        if st.checkbox("Preparar archivos para descargar", key="prepare_downloads"):
+            col1, col2, col3 = st.columns(3)
+            
+            with col1:
+                with open(zip_paths['a'], 'rb') as zip_file:
+                    st.download_button(
+                        label="⬇️ Descargar versión A",
+                        data=zip_file,
+                        file_name=f"escenas_versionA_{timestamp}.zip",
+                        mime="application/zip",
+                        key="download_a"
+                    )
+            
+            with col2:
+                with open(zip_paths['b'], 'rb') as zip_file:
+                    st.download_button(
+                        label="⬇️ Descargar versión B",
+                        data=zip_file,
+                        file_name=f"escenas_versionB_{timestamp}.zip",
+                        mime="application/zip",
+                        key="download_b"
+                    )
+            
+            with col3:
+                with open(zip_paths['c'], 'rb') as zip_file:
+                    st.download_button(
+                        label="⬇️ Descargar versión C",
+                        data=zip_file,
+                        file_name=f"escenas_versionC_{timestamp}.zip",
+                        mime="application/zip",
+                        key="download_c"
+                    )
+            
+            st.success("Los archivos están listos para descargar. Cada versión (A, B, C) contiene todas las escenas.")
         
-        st.success("Los archivos están listos para descargar. Cada versión (A, B, C) contiene todas las escenas.")
+        # Mostrar solo la escena seleccionada, leyendo los audios desde los ZIP
+        scenes = st.session_state.current_generation['scenes']
+        selected_scene = st.selectbox("Ver escena", range(1, len(scenes) + 1),
+                                      format_func=lambda i: f"Escena {i}")
+        st.write(scenes[selected_scene - 1])
+        for version in VERSIONS:
+            audio_content = read_audio_from_zip(zip_paths[version], selected_scene, version)
+            if audio_content:
+                st.audio(audio_content, format="audio/mp3")
+                st.caption(f"Versión: escena_{selected_scene}{version}.mp3")
 
 if __name__ == "__main__":
     main()
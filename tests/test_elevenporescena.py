@@ -0,0 +1,147 @@
+"""
+Pruebas del uso de la caché de Streamlit desde los hilos de generación.
+Se ejecutan dentro de un ScriptRunner real para reproducir el contexto de la app.
+"""
+import pathlib
+import socket
+import sys
+import textwrap
+import threading
+import unittest
+
+import requests
+
+import streamlit as st
+from streamlit.testing.script_interactions import InteractiveScriptTests
+
+REPO_DIR = pathlib.Path(__file__).resolve().parents[1]
+
+SCRIPT_HEADER = f"""
+import sys
+sys.path.insert(0, {str(REPO_DIR)!r})
+import streamlit as st
+import elevenporescena as app
+"""
+
+# Dobles de prueba disponibles en los scripts: registran las solicitudes sin red
+SCRIPT_HELPERS = """
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self):
+        self.posts = []
+
+    def post(self, url, json, headers, timeout):
+        self.posts.append(json["text"])
+        return FakeResponse(json["text"].encode())
+
+
+def generate(session, rate_limiter, text, letter="a"):
+    return app.generate_audio_version(session, rate_limiter, text, "key", "voice",
+                                      0.5, 0.75, True, 1, letter)
+"""
+
+
+class WorkerCacheTests(InteractiveScriptTests):
+    def setUp(self):
+        super().setUp()
+        st.cache_data.clear()
+        st.cache_resource.clear()
+
+    def run_script(self, body):
+        """
+        Ejecuta el código dado tras importar la app y devuelve los st.text emitidos
+        """
+        script = self.script_from_string(SCRIPT_HEADER + SCRIPT_HELPERS + textwrap.dedent(body))
+        tree = script.run(timeout=20)
+        self.assertEqual(script.script_thread_exceptions, [])
+        return [text.value for text in tree.get("text")]
+
+    def test_cache_is_shared_with_worker_threads(self):
+        texts = self.run_script("""
+            calls = []
+
+            @st.cache_data(show_spinner=False)
+            def cached(value):
+                calls.append(value)
+                return value
+
+            with app.create_executor(2) as executor:
+                list(executor.map(cached, ["x", "x", "x"]))
+            st.text(str(len(calls)))
+        """)
+        self.assertEqual(texts, ["1"])
+
+    def test_rate_limiter_is_shared_across_workers(self):
+        texts = self.run_script("""
+            session = FakeSession()
+            rate_limiter = app.get_rate_limiter("key")
+            with app.create_executor(2) as executor:
+                list(executor.map(lambda text: generate(session, rate_limiter, text),
+                                  ["uno", "dos", "tres"]))
+                same = executor.submit(
+                    lambda: app.get_rate_limiter("key") is rate_limiter
+                ).result()
+            st.text(str(len(app.get_rate_limiter("key")._timestamps)))
+            st.text(str(same))
+            st.text(str(app.get_rate_limiter("otra") is rate_limiter))
+        """)
+        self.assertEqual(texts, ["3", "True", "False"])
+
+    def test_identical_generation_is_not_requested_twice(self):
+        texts = self.run_script("""
+            session = FakeSession()
+            rate_limiter = app.get_rate_limiter("key")
+            with app.create_executor(2) as executor:
+                executor.submit(generate, session, rate_limiter, "escena").result()
+                executor.submit(generate, session, rate_limiter, "escena").result()
+                executor.submit(generate, session, rate_limiter, "escena", "b").result()
+            st.text(str(session.posts))
+        """)
+        self.assertEqual(texts, ["['escena', 'escena']"])
+
+
+class RequestNotSentTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        sys.path.insert(0, str(REPO_DIR))
+        import elevenporescena
+        cls.app = elevenporescena
+
+    def post_error(self, url):
+        with self.assertRaises(requests.RequestException) as context:
+            self.app.get_session().post(url, json={}, timeout=5)
+        return context.exception
+
+    def test_connection_refused_is_retryable(self):
+        with socket.socket() as server:
+            server.bind(("127.0.0.1", 0))
+            port = server.getsockname()[1]
+        error = self.post_error(f"http://127.0.0.1:{port}")
+        self.assertTrue(self.app.request_not_sent(error))
+
+    def test_connection_dropped_after_sending_is_not_retryable(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        self.addCleanup(server.close)
+
+        def drop_connection():
+            connection, _ = server.accept()
+            connection.recv(65536)
+            connection.close()
+
+        threading.Thread(target=drop_connection, daemon=True).start()
+        port = server.getsockname()[1]
+        error = self.post_error(f"http://127.0.0.1:{port}")
+        self.assertFalse(self.app.request_not_sent(error))
+        self.assertFalse(self.app.request_not_sent(requests.ReadTimeout()))